@@ -31,7 +31,11 @@
 """
 
 
+import mmap
 import struct
+import sys
+from array import array
+from itertools import chain, islice
 
 
 import lx
@@ -53,8 +57,22 @@ binary_property_types = {
     "uint": "I",
     "float": "f",
     "double": "d",
+    "int8": "b",
+    "uint8": "B",
+    "int16": "h",
+    "uint16": "H",
+    "int32": "i",
+    "uint32": "I",
+    "float32": "f",
+    "float64": "d",
 }
 
+# Number of points or polygons to create between each update of the monitor.
+MONITOR_STEP = 4096
+
+# Number of fixed size face records decoded between each check of their counts.
+DECODE_STEP = 4096
+
 ascii_property_types = {
     "char": int,
     "uchar": int,
@@ -64,12 +82,56 @@ ascii_property_types = {
     "uint": int,
     "float": float,
     "double": float,
+    "int8": int,
+    "uint8": int,
+    "int16": int,
+    "uint16": int,
+    "int32": int,
+    "uint32": int,
+    "float32": float,
+    "float64": float,
 }
 
 
+def _byteorder(format):
+    """ Get the byte order of a binary ply format, in the same form as
+    sys.byteorder
+
+    :param format: ply format string
+
+    """
+    return "big" if format == "binary_big_endian" else "little"
+
+
+def _array_from_bytes(typecode, data):
+    """ Decode raw bytes into an array with given typecode """
+    values = array(typecode)
+    try:
+        values.frombytes(data)
+    except AttributeError:  # python 2
+        values.fromstring(data)
+    return values
+
+
+def _iter_unpack(record, data):
+    """ Iterate over back to back records in data
+
+    :param record: struct.Struct describing a single record
+    :param data: bytes like object holding the records
+
+    """
+    try:
+        return record.iter_unpack(data)
+    except AttributeError:  # python 2
+        offsets = range(0, len(data) - record.size + 1, record.size)
+        return (record.unpack_from(data, offset) for offset in offsets)
+
+
 class PLYLoader(lxifc.Loader):
     def __init__(self):
         self.filehandle = None
+        self.mm = None  # memory map of the file, if the platform allows it
+        self.stream = None  # either of the above, used for all reads
         self.scene_service = lx.service.Scene()
         self.load_target = None
 
@@ -86,13 +148,275 @@ class PLYLoader(lxifc.Loader):
         self.elements = []
         self.end_header = 0
 
+        self.stream = None
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                pass  # a view is still alive, the map is freed along with it
+            self.mm = None
+
         if self.filehandle:
             self.filehandle.close()
         return lx.result.OK
 
+    def _read(self, size):
+        """ Read size bytes from the current position of the stream. When
+        the file is memory mapped this returns a view into the map instead
+        of copying the bytes.
+
+        :param size: number of bytes to read
+
+        """
+        if self.mm is None:
+            return self.filehandle.read(size)
+
+        start = self.mm.tell()
+        end = min(start + size, len(self.mm))
+        self.mm.seek(end)
+        try:
+            return memoryview(self.mm)[start:end]
+        except TypeError:  # python 2 mmap doesn't support memoryview
+            return self.mm[start:end]
+
     def load_LoadInstance(self, loadInfo, monitor):
         pass
 
+    def _compile_element(self, element):
+        """ Prepare everything needed to decode an element once the format
+        is known, so reading the body only has to look it up. Only vertex
+        and face elements are read, and only the types the readers use are
+        looked up. Throws lx.result.NOTFOUND for those we don't know about.
+
+        :param element: element dictionary from the header
+
+        """
+        name = element["name"]
+        if name not in ("vertex", "face"):
+            return
+
+        properties = element["properties"]
+        try:
+            if self.format == "ascii":
+                # Faces are parsed as ints regardless of their types,
+                if name == "vertex":
+                    element["converters"] = [ascii_property_types[p["type"]] for p in properties[:3]]
+                return
+
+            fmt = ">" if self.format == "binary_big_endian" else "<"
+            if name == "face":
+                element["count_type"] = binary_property_types[properties[0]["size"]]
+                element["count_struct"] = struct.Struct(fmt + element["count_type"])
+                element["index_type"] = binary_property_types[properties[0]["type"]]
+                return
+
+            types = [binary_property_types[p["type"]] for p in properties]
+        except (KeyError, IndexError) as e:
+            lx.out("Unsupported property {}...".format(e))
+            lx.throw(lx.result.NOTFOUND)
+
+        element["record"] = struct.Struct(fmt + "".join(types))
+
+        # Struct only unpacking the first three properties, assumed to be
+        # position xyz, skipping over the rest of the record as padding.
+        position = fmt + "".join(types[:3])
+        padding = element["record"].size - struct.calcsize(position)
+        element["position_struct"] = struct.Struct(position + "{}x".format(padding))
+
+        # Elements where every property has the same type can be read as a
+        # flat array, as long as the array item matches the size in the file.
+        element["typecode"] = None
+        if len(set(types)) == 1 and array(types[0]).itemsize == struct.calcsize(fmt + types[0]):
+            element["typecode"] = types[0]
+
+    def _read_ascii_vertices(self, element):
+        """ Read an ascii vertex element, returning an iterator over the
+        position of each vertex
+
+        :param element: element dictionary from the header
+
+        """
+        types = element['converters']
+
+        # Each element is expected to be stored on one line. Read the
+        # whole block in one go and tokenize it with a single split,
+        # then convert only the position columns, assuming here the
+        # first three properties are position xyz. The columns are packed
+        # into arrays of doubles so the tokens can be freed before the
+        # points are created.
+        count = element['count']
+        lines = islice(iter(self.stream.readline, b""), count)
+        tokens = b" ".join(lines).split()
+        stride = len(element['properties'])
+        columns = [array('d', map(t, tokens[i::stride])) for i, t in enumerate(types)]
+        return zip(*columns)
+
+    def _read_ascii_faces(self, element):
+        """ Read an ascii face element, returning a list with the number of
+        indices for each face and a flat array of all vertex indices
+
+        :param element: element dictionary from the header
+
+        """
+        face_sizes = []
+        face_indices = array('l')
+
+        count = element['count']
+        lines = list(islice(iter(self.stream.readline, b""), count))
+        tokens = b" ".join(lines).split()
+
+        # Most files only use one kind of polygon, if the arity from
+        # the first line holds for the whole block we can convert
+        # all tokens at once and drop the leading counts.
+        arity = int(tokens[0]) if tokens else 0
+        stride = arity + 1
+        if tokens and len(tokens) == count * stride and tokens[::stride].count(tokens[0]) == count:
+            face_indices.extend(map(int, tokens))
+            del face_indices[::stride]
+            face_sizes.extend([arity] * count)
+        else:
+            append_size = face_sizes.append
+            extend_indices = face_indices.extend
+            for line in lines:
+                data = line.split()
+                append_size(len(data) - 1)
+                extend_indices(map(int, data[1:]))
+
+        return face_sizes, face_indices
+
+    def _read_binary_vertices(self, element):
+        """ Read a binary vertex element, returning an iterator over the
+        position of each vertex
+
+        :param element: element dictionary from the header
+
+        """
+        record = element['record']
+
+        count = element['count']
+        data = self._read(record.size * count)
+
+        # When all properties share the same type the whole block
+        # can be decoded as one flat array, only swapping bytes if
+        # the file doesn't match the byte order of this machine.
+        typecode = element['typecode']
+        if typecode is not None:
+            values = _array_from_bytes(typecode, data)
+            if _byteorder(self.format) != sys.byteorder:
+                values.byteswap()
+            stride = len(element['properties'])
+            return zip(values[0::stride], values[1::stride], values[2::stride])
+
+        return _iter_unpack(element['position_struct'], data)
+
+    def _read_binary_faces(self, element):
+        """ Read a binary face element, returning a list with the number of
+        indices for each face and a flat array of all vertex indices
+
+        :param element: element dictionary from the header
+
+        """
+        face_sizes = []
+        face_indices = array('l')
+
+        face_count = element['count']
+        if not face_count:
+            return face_sizes, face_indices  # nothing to read, the bytes ahead belong to the next element
+
+        fmt = ">" if self.format == "binary_big_endian" else "<"
+        count_struct = element['count_struct']
+        count_type = element['count_type']
+        index_type = element['index_type']
+
+        # Peek at the number of indices in the first face, if all
+        # faces share it the block is just fixed size records and
+        # can be decoded in one go.
+        start = self.stream.tell()
+        peek = self.stream.read(count_struct.size)
+        arity = count_struct.unpack(peek)[0] if len(peek) == count_struct.size else 0
+        self.stream.seek(start)
+
+        # A negative count can't be a polygon, leave it to the per-face reader
+        records = None
+        stride = arity + 1
+        if arity >= 0:
+            record = struct.Struct(fmt + count_type + str(arity) + index_type)
+            try:
+                records = _iter_unpack(record, self._read(record.size * face_count))
+            except struct.error:  # block shorter than expected, sizes must vary
+                records = None
+
+        # Decode the records straight into the index array a chunk at a time,
+        # giving up on the first chunk with a count not matching the arity.
+        decoded = 0
+        while records is not None and decoded < face_count:
+            chunk = min(DECODE_STEP, face_count - decoded)
+            face_indices.extend(chain.from_iterable(islice(records, chunk)))
+            if face_indices[decoded * stride::stride].count(arity) != chunk:
+                del face_indices[:]
+                records = None
+            decoded += chunk
+
+        if records is not None:
+            del face_indices[::stride]
+            face_sizes.extend([arity] * face_count)
+            return face_sizes, face_indices
+
+        self.stream.seek(start)
+
+        # With variable length of list properties each face needs two
+        # reads, but the structs are only built once for the count and once
+        # for each polygon size found.
+        index_structs = {}
+
+        def get_index_struct(num_indices):
+            index_struct = index_structs.get(num_indices)
+            if index_struct is None:
+                index_struct = struct.Struct(fmt + str(num_indices) + index_type)
+                index_structs[num_indices] = index_struct
+            return index_struct
+
+        unpack_count_from = count_struct.unpack_from
+        count_size = count_struct.size
+        append_size = face_sizes.append
+        extend_indices = face_indices.extend
+
+        # A memory mapped file is unpacked in place,
+        if self.mm is not None:
+            mm = self.mm
+            offset = start
+            for _ in range(face_count):
+                num_indices, = unpack_count_from(mm, offset)
+                index_struct = get_index_struct(num_indices)
+                append_size(num_indices)
+                extend_indices(index_struct.unpack_from(mm, offset + count_size))
+                offset += count_size + index_struct.size
+            mm.seek(offset)
+            return face_sizes, face_indices
+
+        # otherwise each record is read into a buffer reused for every face
+        # of the same size, instead of allocating new bytes for each read.
+        readinto = self.filehandle.readinto
+        count_buffer = bytearray(count_size)
+        index_buffers = {}
+        for _ in range(face_count):
+            # First read how many indices we can expect,
+            if readinto(count_buffer) != count_size:
+                raise struct.error("unexpected end of file")
+            num_indices, = unpack_count_from(count_buffer)
+
+            # Then read the indices
+            index_struct = get_index_struct(num_indices)
+            index_buffer = index_buffers.get(num_indices)
+            if index_buffer is None:
+                index_buffer = index_buffers[num_indices] = bytearray(index_struct.size)
+            if readinto(index_buffer) != index_struct.size:
+                raise struct.error("unexpected end of file")
+            append_size(num_indices)
+            extend_indices(index_struct.unpack_from(index_buffer))
+
+        return face_sizes, face_indices
+
     def load_LoadObject(self, loadInfo, monitor, dest):
         """ 
 
@@ -105,96 +429,6 @@ class PLYLoader(lxifc.Loader):
 
         _monitor = lx.object.Monitor(monitor)
 
-        # Set position of file at end of header,
-        self.filehandle.seek(self.end_header)
-
-        vertices = []
-        faces = []
-
-        lx.out("Parsing properties...")
-        if self.format == "ascii":
-            for element in self.elements:
-                if element.get('name') == "vertex":
-                    lx.out("Vertex element found...")
-                    # For this element, read expected types to list
-                    types = []
-                    for prop in element.get("properties"):
-                        types.append(ascii_property_types.get(prop.get('type')))
-
-                    # Each element is expected to be stored on one line, parse each
-                    # line with expected property types.
-                    for _ in range(element.get('count', 0)):
-                        data = tuple(t(value) for t, value in zip(types, str(self.filehandle.readline().decode('ascii')).strip().split()))
-                        vertices.append(data[:3]) # push the first three types, assuming here they are position xyz
-
-                    lx.out("Read {} vertices...".format(len(vertices)))
-
-                elif element.get('name') == "face":
-                    lx.out("Face element found...")
-                    for _ in range(element.get('count', 0)):
-                        data = str(self.filehandle.readline().decode('ascii').strip()).split()
-                        faces.append(tuple(int(d) for d in data[1:]))
-                    lx.out("Read {} faces...".format(len(faces)))
-        
-        else:
-            chunk_size = 1024
-            for element in self.elements:
-                if element.get('name') == "vertex":
-
-                    # Get the struct format
-                    fmt = ">" if self.format == "binary_big_endian" else "<"
-                    for prop in element.get("properties"):
-                        fmt += binary_property_types.get(prop.get("type"))
-
-                    size = struct.calcsize(fmt) # each vertex have this size
-                    total_size = size * element.get('count', 0) # the total byte size for all vertices
-
-                    read_size = chunk_size - (chunk_size % size) # byte size we will read to get full set of vertices
-
-                    num_reads = total_size // read_size # the number of reads we will have to make
-                    num_verts = read_size // size # number of verts will be read 
-                    overflow = total_size % read_size # how many bytes are left after reading all full segments
-
-                    _monitor.Initialize(num_reads + 1 if overflow else num_reads)
-
-                    for _ in range(num_reads):
-                        data = self.filehandle.read(read_size)
-                        for x in range(num_verts):
-                            vertex = struct.unpack_from(fmt, data, offset=x*size)
-                            vertices.append(vertex)
-                            _monitor.Increment(1)
-
-                    data = self.filehandle.read(overflow)
-                    for x in range(overflow // size):
-                        vertex = struct.unpack_from(fmt, data, offset=x*size)
-                        vertices.append(vertex)
-                        _monitor.Increment(1)
-
-                elif element.get('name') == "face":
-                    face_count = element.get('count', 0)
-                    _monitor.Initialize(face_count)
-                    for _ in range(face_count):
-                        # With potentially variable length of list properties,
-                        # I think I might have to make this many reads :(
-
-                        pos = self.filehandle.tell()
-
-                        # First read how many indices we can expect, should be int/uchar so always single digit
-                        fmt = '>' + binary_property_types.get(element['properties'][0]['size'])
-                        size = struct.calcsize(fmt)
-                        data = self.filehandle.read(size)
-                        num_indices, = struct.unpack(fmt, data)
-
-                        # Then read the indices
-                        t = binary_property_types.get(element['properties'][0]['type'])
-                        fmt = '>' + str(num_indices) + t
-                        size = struct.calcsize(fmt)
-                        data = self.filehandle.read(size)
-                        indices = struct.unpack(fmt, data)
-                        faces.append(indices)
-
-                        _monitor.Increment(1)
-
         scene = lx.object.Scene(dest)
 
         item = scene.ItemAdd(
@@ -214,34 +448,130 @@ class PLYLoader(lxifc.Loader):
         if not point.test() and not polygon.test():
             lx.throw(lx.result.FALSE)
 
-        # vertex should be a tuple for position,
-        points = {}
-        lx.out("Generating points...")
-        _monitor.Initialize(len(vertices))
-        for index, position in enumerate(vertices):
-            points[index] = point.New(position)
-            _monitor.Increment(1)
-
-        lx.out("Generating polygons from points...")
-        _monitor.Initialize(len(faces))
-        for face in faces:
-            vertIds = tuple(points[i] for i in face)
-            storage = lx.object.storage('p', len(vertIds))
-            for index, _id in enumerate(vertIds):
-                storage[index] = _id
-            polygon.New(lx.symbol.iPTYP_FACE, storage, len(vertIds), 0)
-            _monitor.Increment(1)
+        # Set position of file at end of header,
+        self.stream.seek(self.end_header)
+
+        # Elements are read one at a time and points go straight into the
+        # mesh, the point ids are kept in a list indexed the same way as the
+        # vertices in the file. Faces may come before the vertices in the
+        # file, so they are held until all points exist,
+        points = []
+        faces = []
+        new_point = point.New
+        add_point = points.append
+        new_polygon = polygon.New
+        face_type = lx.symbol.iPTYP_FACE
+        increment = _monitor.Increment
+
+        for element in self.elements:
+            name = element['name']
+            if name == "vertex":
+                if self.format == "ascii":
+                    positions = self._read_ascii_vertices(element)
+                else:
+                    positions = self._read_binary_vertices(element)
+
+                # vertex should be a tuple for position,
+                _monitor.Initialize(element['count'])
+                created = 0
+                for created, position in enumerate(positions, 1):
+                    add_point(new_point(position))
+                    if not created % MONITOR_STEP:
+                        increment(MONITOR_STEP)
+                increment(created % MONITOR_STEP)
+
+                lx.out("Read {} vertices...".format(len(points)))
+
+            elif name == "face":
+                if self.format == "ascii":
+                    faces.append(self._read_ascii_faces(element))
+                else:
+                    faces.append(self._read_binary_faces(element))
+
+        # Polygon.New copies the point ids, so one storage per polygon size
+        # can be reused for every face of that size.
+        storages = {}
+        for face_sizes, face_indices in faces:
+            _monitor.Initialize(len(face_sizes))
+            offset = 0
+            created = 0
+            for created, size in enumerate(face_sizes, 1):
+                vertIds = [points[i] for i in face_indices[offset:offset + size]]
+                storage = storages.get(size)
+                if storage is None:
+                    storage = storages[size] = lx.object.storage('p', size)
+                storage.set(vertIds)
+                new_polygon(face_type, storage, size, 0)
+                offset += size
+                if not created % MONITOR_STEP:
+                    increment(MONITOR_STEP)
+            increment(created % MONITOR_STEP)
+
+            lx.out("Read {} faces...".format(len(face_sizes)))
 
         # Add comments from header to the item
         if self.comments:
-            lx.out("Adding comments from file to the mesh object...")
             tag = lx.object.StringTag(item)
-            tag.Set(lx.symbol.iTAG_COMMENT, "\n".join(self.comments))
+            comments = b"\n".join(self.comments).decode("ascii", "replace")
+            tag.Set(lx.symbol.iTAG_COMMENT, comments)
 
         mesh.SetMeshEdits(lx.symbol.f_MESHEDIT_POLYGONS)
 
         return lx.result.OK
 
+    def _parse_comment(self, rest):
+        """ Store a comment line from the header, kept as bytes until it's
+        added to the mesh
+
+        :param rest: the line following the 'comment' keyword
+
+        """
+        self.comments.append(rest)
+
+    def _parse_element(self, rest):
+        """ Start a new element from an 'element <name> <count>' line
+
+        :param rest: the line following the 'element' keyword
+
+        """
+        try:
+            name, count = rest.split()
+            count = int(count)
+        except ValueError:
+            lx.out("Failed to parse element: {}".format(rest.decode("ascii", "replace")))
+            lx.throw(lx.result.NOTFOUND)
+
+        # Names and counts are converted here once, so the loader can compare
+        # and count with them directly.
+        element = {"name": name.decode("ascii"), "count": count, "properties": []}
+        lx.out("Counting {} {}".format(element["count"], element["name"]))
+        self.elements.append(element)
+
+    def _parse_property(self, rest):
+        """ Add a property to the most recently defined element
+
+        :param rest: the line following the 'property' keyword
+
+        """
+        if not self.elements:
+            lx.out("Property found before any element...")
+            lx.throw(lx.result.NOTFOUND)
+        element = self.elements[-1]
+
+        fields = rest.split()
+        if len(fields) == 2:  # regular 'scalar' property
+            datatype, name = fields
+            element["properties"].append(
+                    {"name": name.decode("ascii"), "type": datatype.decode("ascii")})
+
+        elif len(fields) == 4:  # list type property
+            _, size, datatype, name = fields
+            element["properties"].append(
+                    {"name": name.decode("ascii"), "type": datatype.decode("ascii"), "size": size.decode("ascii")})
+        else:
+            lx.out("Unsupported property found...")
+            lx.throw(lx.result.NOTFOUND)
+
     def load_Recognize(self, filename, loadInfo):
         """ If we don't recognize the format, we should return
         lx.result.NOTFOUND
@@ -253,66 +583,62 @@ class PLYLoader(lxifc.Loader):
 
         self.filehandle = open(filename, "rb")
 
+        # Prefer reading through a memory map, letting the os page in the
+        # file on demand, but fall back on the file object if mapping fails.
+        try:
+            self.mm = mmap.mmap(self.filehandle.fileno(), 0, access=mmap.ACCESS_READ)
+        except (ValueError, EnvironmentError):
+            self.mm = None
+        self.stream = self.filehandle if self.mm is None else self.mm
+
         # Early exit if magic number not found,
-        magicnumber = str(self.filehandle.readline().decode('ascii').strip())
-        if magicnumber != "ply":
+        if self.stream.readline().strip() != b"ply":
             lx.out("File missing 'ply' in the header...")
             lx.throw(lx.result.NOTFOUND)
 
         # Line after magic number should define the format,
         # not doing full check, only looking for the second value
         # to match the allowed format types
-        _, format, version = self.filehandle.readline().split()
+        _, format, version = self.stream.readline().split()
         self.format = format.decode("ascii")
         if self.format not in SUPPORTED_FORMATS:
             lx.out("Failed to get file format...")
             lx.throw(lx.result.NOTFOUND)
 
         lx.out("Recognized format as {}".format(self.format))
-        element = None  # remember the previously defined element,
+
+        # Header lines are dispatched on their first keyword, staying in
+        # bytes and only decoding the values we keep.
+        handlers = {
+            b"comment": self._parse_comment,
+            b"element": self._parse_element,
+            b"property": self._parse_property,
+        }
 
         # Read rest of the headers, raising lookup error when header
         # couldn't be parsed.
-        while self.filehandle:
-            line = str(self.filehandle.readline().decode("ascii").strip())
+        while self.stream:
+            line = self.stream.readline().strip()
 
-            if line == "end_header":
-                break  # We've reached the end of header,
+            # Split off the keyword on any whitespace, as files in the wild
+            # separate the header fields with tabs as well as spaces,
+            fields = line.split(None, 1)
+            keyword = fields[0] if fields else b""
+            rest = fields[1] if len(fields) > 1 else b""
 
-            # Check for comments and read to a list.
-            elif line.startswith("comment"):
-                comment = line[8:]
-                self.comments.append(comment)
-
-            # Parse elements,
-            elif line.startswith("element"):
-                _, name, count = line.split()
-                element = {"name": name, "count": int(count), "properties": []}
-                lx.out("Counting {} {}".format(count, name))
-                self.elements.append(element)
-
-            # Parse properties for elements,
-            elif line.startswith("property"):
-                fields = line.split()
-                if len(fields) == 3:  # regular 'scalar' property
-                    _, datatype, name = fields
-                    element["properties"].append(
-                            {"name": name, "type": datatype})
-                    lx.out("Adding property {} to {}".format(name, element.get("name")))
-
-                elif len(fields) == 5:  # list type property
-                    _, _, size, datatype, name = fields
-                    element["properties"].append(
-                            {"name": name, "type": datatype, "size": size})
-                else:
-                    lx.out("Unsupported property found...")
-                    lx.throw(lx.result.NOTFOUND)
+            if keyword == b"end_header":
+                break  # We've reached the end of header,
 
-            else:
-                lx.out("Failed for parse: {}".format(line))
+            handler = handlers.get(keyword)
+            if handler is None:
+                lx.out("Failed for parse: {}".format(line.decode("ascii", "replace")))
                 lx.throw(lx.result.NOTFOUND)
+            handler(rest)
+
+        self.end_header = self.stream.tell()
 
-        self.end_header = self.filehandle.tell()
+        for element in self.elements:
+            self._compile_element(element)
 
         info = lx.object.LoaderInfo(loadInfo)
         info.SetClass(lx.symbol.u_SCENE)
@@ -0,0 +1,396 @@
+"""
+
+    Tests for the ply loader, run from the root of the kit with
+
+        python -m unittest discover tests
+
+    Modo's lx, lxifc and lxu modules are replaced with minimal stubs that
+    record the points and polygons the loader creates, so the tests run
+    on any python 2 or 3 interpreter.
+
+
+"""
+
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import types
+import unittest
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class LxError(Exception):
+    pass
+
+
+class Recorder(object):
+    """ Collects what the loader creates during a single load """
+
+    def __init__(self):
+        self.points = []
+        self.polygons = []
+        self.comment = None
+
+
+recorder = Recorder()
+
+
+class _Symbol(object):
+    def __getattr__(self, name):
+        return name
+
+
+class _Result(object):
+    OK = 0
+    FALSE = 1
+    NOTFOUND = 2
+
+
+class _Storage(list):
+    def __init__(self, type_="", size=0):
+        list.__init__(self, [None] * size)
+
+    def set(self, values):
+        self[:] = list(values)
+
+
+class _PointAccessor(object):
+    def test(self):
+        return True
+
+    def New(self, position):
+        recorder.points.append(tuple(position))
+        return 100 + len(recorder.points) - 1  # offset ids from indices
+
+
+class _PolygonAccessor(object):
+    def test(self):
+        return True
+
+    def New(self, type_, storage, size, rev):
+        recorder.polygons.append(tuple(_id - 100 for _id in storage[:size]))
+
+
+class _Mesh(object):
+    def __init__(self, obj=None):
+        pass
+
+    def test(self):
+        return True
+
+    def PointAccessor(self):
+        return _PointAccessor()
+
+    def PolygonAccessor(self):
+        return _PolygonAccessor()
+
+    def SetMeshEdits(self, edits):
+        pass
+
+
+class _Item(object):
+    def ChannelLookup(self, name):
+        return name
+
+
+class _Scene(object):
+    def __init__(self, obj=None):
+        pass
+
+    def ItemAdd(self, type_):
+        return _Item()
+
+    def Channels(self, action, time):
+        return None
+
+
+class _ChannelWrite(object):
+    def __init__(self, obj=None):
+        pass
+
+    def ValueObj(self, item, channel):
+        return None
+
+
+class _StringTag(object):
+    def __init__(self, item=None):
+        pass
+
+    def Set(self, tag, value):
+        recorder.comment = value
+
+
+class _Anything(object):
+    """ Accepts any constructor arguments and method calls """
+
+    def __init__(self, *args):
+        pass
+
+    def __getattr__(self, name):
+        return lambda *args: None
+
+
+class _SceneService(object):
+    def ItemTypeLookup(self, name):
+        return name
+
+
+def _throw(code):
+    raise LxError(code)
+
+
+def _install_stubs():
+    lx = types.ModuleType("lx")
+    lx.result = _Result
+    lx.symbol = _Symbol()
+    lx.throw = _throw
+    lx.out = lambda *args: None
+    lx.bless = lambda *args: None
+    lx.service = types.ModuleType("lx.service")
+    lx.service.Scene = _SceneService
+    lx.object = types.ModuleType("lx.object")
+    lx.object.storage = _Storage
+    lx.object.Monitor = _Anything
+    lx.object.Mesh = _Mesh
+    lx.object.Scene = _Scene
+    lx.object.ChannelWrite = _ChannelWrite
+    lx.object.StringTag = _StringTag
+    lx.object.LoaderInfo = _Anything
+    lx.object.SceneLoaderTarget = _Anything
+
+    lxifc = types.ModuleType("lxifc")
+    lxifc.Loader = object
+
+    sys.modules["lx"] = lx
+    sys.modules["lxifc"] = lxifc
+    sys.modules["lxu"] = types.ModuleType("lxu")
+
+
+_install_stubs()
+sys.path.insert(0, os.path.join(HERE, "..", "lxserv"))
+import plykit_loader  # noqa: E402
+
+
+class _NoMmap(object):
+    """ Stand in for the mmap module on platforms where mapping fails """
+
+    ACCESS_READ = 1
+
+    @staticmethod
+    def mmap(*args, **kwargs):
+        raise EnvironmentError("mmap not available")
+
+
+def load(path, use_mmap=True):
+    """ Run a full load of path, returning the recorder holding the result
+
+    :param path: path to ply file
+    :param use_mmap: if False, loading falls back on plain file reads
+
+    """
+    global recorder
+    recorder = Recorder()
+
+    real_mmap = plykit_loader.mmap
+    if not use_mmap:
+        plykit_loader.mmap = _NoMmap
+    try:
+        loader = plykit_loader.PLYLoader()
+        try:
+            loader.load_Recognize(path, None)
+            loader.load_LoadObject(None, None, None)
+        finally:
+            loader.load_Cleanup()
+    finally:
+        plykit_loader.mmap = real_mmap
+    return recorder
+
+
+BINARY_TYPES = {
+    "char": "b", "uchar": "B", "short": "h", "ushort": "H",
+    "int": "i", "uint": "I", "float": "f", "double": "d",
+    "uint8": "B", "int32": "i", "float32": "f",
+}
+
+
+def write_ply(path, format, vertex_types, vertices, faces,
+              count_type="uchar", index_type="int", extra_header=(),
+              faces_first=False):
+    """ Write a ply file with a vertex element followed by a face element,
+    or the other way around
+
+    :param path: destination path
+    :param format: one of the ply formats
+    :param vertex_types: property type for each vertex value
+    :param vertices: list of tuples of vertex values
+    :param faces: list of tuples of vertex indices
+    :param extra_header: header lines added after both elements
+    :param faces_first: write the face element before the vertex element
+
+    """
+    names = ["x", "y", "z", "red", "green", "blue", "alpha"]
+    vertex_header = ["element vertex {}".format(len(vertices))]
+    for name, datatype in zip(names, vertex_types):
+        vertex_header.append("property {} {}".format(datatype, name))
+    face_header = [
+        "element face {}".format(len(faces)),
+        "property list {} {} vertex_indices".format(count_type, index_type),
+    ]
+
+    if format == "ascii":
+        vertex_data = b"".join((" ".join(str(v) for v in vertex) + "\n").encode("ascii") for vertex in vertices)
+        face_data = b"".join((" ".join(str(i) for i in (len(face),) + face) + "\n").encode("ascii") for face in faces)
+    else:
+        endian = ">" if format == "binary_big_endian" else "<"
+        vertex_fmt = endian + "".join(BINARY_TYPES[t] for t in vertex_types)
+        vertex_data = b"".join(struct.pack(vertex_fmt, *vertex) for vertex in vertices)
+        face_data = b"".join(
+            struct.pack(endian + BINARY_TYPES[count_type] + str(len(face)) + BINARY_TYPES[index_type], len(face), *face)
+            for face in faces)
+
+    header = ["ply", "format {} 1.0".format(format), "comment test"]
+    if faces_first:
+        header += face_header + vertex_header
+        body = face_data + vertex_data
+    else:
+        header += vertex_header + face_header
+        body = vertex_data + face_data
+    header.extend(extra_header)
+    header.append("end_header")
+
+    with open(path, "wb") as f:
+        f.write(("\n".join(header) + "\n").encode("ascii"))
+        f.write(body)
+
+
+CUBE_POINTS = [
+    (0, 0, 0), (0, 0, 1), (0, 1, 1), (0, 1, 0),
+    (1, 0, 0), (1, 0, 1), (1, 1, 1), (1, 1, 0),
+]
+
+CUBE_POLYGONS = [
+    (0, 1, 2, 3), (7, 6, 5, 4), (0, 4, 5, 1),
+    (1, 5, 6, 2), (2, 6, 7, 3), (3, 7, 4, 0),
+]
+
+FORMATS = ("ascii", "binary_big_endian", "binary_little_endian")
+
+
+class TestFixtures(unittest.TestCase):
+    """ Load the files shipped next to the tests, with and without mmap """
+
+    def check_cube(self, filename, use_mmap):
+        result = load(os.path.join(HERE, filename), use_mmap)
+        self.assertEqual(result.points, CUBE_POINTS)
+        self.assertEqual(result.polygons, CUBE_POLYGONS)
+        self.assertTrue(result.comment.endswith("cube"))
+
+    def test_ascii(self):
+        self.check_cube("cube.ply", True)
+        self.check_cube("cube.ply", False)
+
+    def test_binary_big_endian(self):
+        self.check_cube("cube_binary_big_endian.ply", True)
+        self.check_cube("cube_binary_big_endian.ply", False)
+
+    def test_binary_little_endian(self):
+        self.check_cube("cube_binary_little_endian.ply", True)
+        self.check_cube("cube_binary_little_endian.ply", False)
+
+    def test_points_no_faces(self):
+        for use_mmap in (True, False):
+            result = load(os.path.join(HERE, "points_no_faces.ply"), use_mmap)
+            self.assertEqual(result.points, [(0, 0, 0), (1, 0, 0), (0, 1, 0)])
+            self.assertEqual(result.polygons, [])
+
+
+class TestGeneratedFiles(unittest.TestCase):
+    """ Load files written on the fly, covering each format branch """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, "test.ply")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check(self, vertex_types, vertices, faces, **kwargs):
+        for format in FORMATS:
+            write_ply(self.path, format, vertex_types, vertices, faces, **kwargs)
+            for use_mmap in (True, False):
+                result = load(self.path, use_mmap)
+                self.assertEqual(result.points, [v[:3] for v in vertices], format)
+                self.assertEqual(result.polygons, faces, format)
+
+    def test_no_faces(self):
+        vertices = [(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)]
+        self.check(("float", "float", "float"), vertices, [])
+
+    def test_mixed_arity(self):
+        vertices = [(float(i), i * 0.5, -i * 0.25) for i in range(6)]
+        faces = [(0, 1, 2), (2, 3, 4, 5), (5, 4, 3), (0, 1, 2, 3, 4)]
+        self.check(("float", "float", "float"), vertices, faces)
+
+    def test_mixed_arity_after_first_chunk(self):
+        # Fixed size faces are checked in chunks, the quad at the end only
+        # shows up after the first chunk has been decoded.
+        vertices = [(float(i), 0.0, 0.0) for i in range(4)]
+        faces = [(0, 1, 2)] * (plykit_loader.DECODE_STEP + 10) + [(0, 1, 2, 3)]
+        self.check(("float", "float", "float"), vertices, faces)
+
+    def test_mixed_vertex_types(self):
+        vertices = [(float(i), i * 0.5, -i * 0.25, i, 2 * i, 255) for i in range(4)]
+        faces = [(0, 1, 2), (1, 2, 3)]
+        types_ = ("float", "float", "float", "uchar", "uchar", "uchar")
+        self.check(types_, vertices, faces)
+
+    def test_double_vertices_int_count(self):
+        vertices = [(0.1, 0.2, 0.3), (1.5, 2.5, 3.5), (-1.0, -2.0, -3.0)]
+        faces = [(0, 1, 2)]
+        self.check(("double", "double", "double"), vertices, faces, count_type="int", index_type="uint")
+
+    def test_type_aliases(self):
+        vertices = [(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)]
+        faces = [(0, 1, 2)]
+        self.check(("float32", "float32", "float32"), vertices, faces, count_type="uint8", index_type="int32")
+
+    def test_unread_element_with_unknown_type(self):
+        vertices = [(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)]
+        faces = [(0, 1, 2)]
+        extra = ("element material 0", "property string name")
+        self.check(("float", "float", "float"), vertices, faces, extra_header=extra)
+
+    def test_faces_before_vertices(self):
+        vertices = [(float(i), i * 0.5, -i * 0.25) for i in range(5)]
+        faces = [(0, 1, 2), (1, 2, 3, 4)]
+        self.check(("float", "float", "float"), vertices, faces, faces_first=True)
+
+    def test_no_faces_before_vertices(self):
+        # The empty face element is followed by vertex data, which must not
+        # be read as face counts, negative floats included.
+        vertices = [(-1.0, 2.0, 3.0), (4.0, -5.0, 6.0), (-7.5, -8.0, -9.25)]
+        self.check(("float", "float", "float"), vertices, [], count_type="int", faces_first=True)
+
+    def test_tab_separated_header(self):
+        vertices = [(0.0, 0.0, 0.0), (1.0, 0.0, 0.0), (0.0, 1.0, 0.0)]
+        faces = [(0, 1, 2)]
+        for format in FORMATS:
+            write_ply(self.path, format, ("float", "float", "float"), vertices, faces)
+            with open(self.path, "rb") as f:
+                header, body = f.read().split(b"end_header\n", 1)
+            with open(self.path, "wb") as f:
+                f.write(header.replace(b" ", b"\t") + b"end_header\n" + body)
+
+            result = load(self.path)
+            self.assertEqual(result.points, vertices, format)
+            self.assertEqual(result.polygons, faces, format)
+            self.assertEqual(result.comment, "test")
+
+
+if __name__ == "__main__":
+    unittest.main()